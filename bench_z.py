@@ -0,0 +1,423 @@
+"""
+Benchmarks for z.py on synthetic data, no live Atlas/RIPEstat needed.
+
+    python bench_z.py                      # all benchmarks, default sizes
+    python bench_z.py --only parse,ixp     # a subset
+    python bench_z.py --probes 40 --latency-ms 50 --json bench.json
+    python bench_z.py --only parse --hops 10-30 --timeout-rate 0.3
+
+A local HTTP stand-in serves the Atlas results and RIPEstat network-info
+endpoints with configurable latency; z.py is pointed at it through
+ATLAS_RESULTS_URL / RIPESTAT_NETWORK_INFO_URL. Every benchmark reports
+throughput and the peak Python heap (tracemalloc); the two come from separate
+runs, so tracing does not slow down the timed one.
+"""
+import argparse
+import gc
+import ipaddress
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+import z
+
+ROOT_PREFIX = "193.0.14."          # k-root anycast, see ROOT_ASN
+ROOT_ASN = 25152
+
+# -------------------
+# Synthetic Atlas data
+# -------------------
+def synth_traceroute(rnd: random.Random, msm_id: int, prb_id: int, ts: int,
+                     hops: Tuple[int, int] = (6, 16), timeout_rate: float = 0.15,
+                     paths: int = 4) -> Dict[str, Any]:
+    """One Atlas traceroute result shaped like the real API output (3 replies/hop)."""
+    # a probe mostly repeats a handful of paths, like real root traceroutes
+    path_rnd = random.Random(f"{msm_id}-{prb_id}-{rnd.randrange(paths)}")
+    n_hops = path_rnd.randint(*hops)
+    result = []
+    for h in range(1, n_hops + 1):
+        if h == n_hops:
+            ip = f"{ROOT_PREFIX}{msm_id % 250 + 1}"
+        elif h == 1:
+            ip = "192.168.1.1"
+        else:
+            ip = (f"{path_rnd.randint(1, 223)}.{path_rnd.randint(0, 255)}."
+                  f"{path_rnd.randint(0, 255)}.{path_rnd.randint(1, 254)}")
+        if h != n_hops and rnd.random() < timeout_rate:
+            result.append({"hop": h, "result": [{"x": "*"}, {"x": "*"}, {"x": "*"}]})
+            continue
+        result.append({"hop": h, "result": [
+            {"from": ip, "ttl": 64 - h, "size": 48, "rtt": round(rnd.random() * 80, 3)}
+            for _ in range(3)
+        ]})
+    return {
+        "fw": 5080, "lts": 12, "endtime": ts + 3, "dst_name": f"{ROOT_PREFIX}129",
+        "dst_addr": f"{ROOT_PREFIX}129", "src_addr": "192.168.1.2", "proto": "ICMP",
+        "af": 4, "size": 48, "paris_id": ts % 16, "result": result, "msm_id": msm_id,
+        "prb_id": prb_id, "timestamp": ts, "msm_name": "Traceroute",
+        "from": "203.0.113.7", "type": "traceroute", "group_id": msm_id,
+        "stored_timestamp": ts + 60,
+    }
+
+
+def synth_results(msm_id: int, probe_ids: List[int], start: int, stop: int,
+                  interval: int = 1800, **kwargs) -> List[Dict[str, Any]]:
+    """
+    All results of `probe_ids` in [start, stop), one traceroute per `interval`
+    seconds. Each result depends only on (msm_id, prb_id, ts), so the same
+    traceroute looks the same whichever window it is fetched in.
+    """
+    out = []
+    for prb_id in probe_ids:
+        first = start + ((prb_id * 97) % interval - start) % interval   # fixed grid per probe
+        for ts in range(first, stop, interval):
+            rnd = random.Random(f"{msm_id}-{prb_id}-{ts}")
+            out.append(synth_traceroute(rnd, msm_id, prb_id, ts, **kwargs))
+    out.sort(key=lambda r: r["timestamp"])
+    return out
+
+
+def write_results_file(path: str, n_traceroutes: int, **kwargs) -> str:
+    """A results file with about n_traceroutes traceroutes (for parser benchmarks)."""
+    interval = 1800
+    start = z.START_TIMESTAMP
+    data = synth_results(5001, [1], start, start + n_traceroutes * interval, interval, **kwargs)
+    with open(path, "w") as f:
+        json.dump(data, f)
+    return path
+
+
+def synth_asn(ip: str) -> List[str]:
+    """Deterministic network-info answer for the stand-in."""
+    if ip.startswith(ROOT_PREFIX):
+        return [str(ROOT_ASN)]
+    try:
+        n = int(ipaddress.ip_address(ip))
+    except ValueError:
+        return []
+    return [str(64512 + (n >> 16) % 1000)] if n % 53 else []
+
+
+# -------------------
+# Local API stand-in
+# -------------------
+class AtlasStandIn:
+    """
+    Threaded local HTTP server for /api/v2/measurements/<id>/results/ and
+    /data/network-info/data.json, adding `latency` seconds to every request.
+    """
+
+    def __init__(self, latency: float = 0.0, interval: int = 1800, **synth_kwargs):
+        self.latency = latency
+        self.interval = interval
+        self.synth_kwargs = synth_kwargs
+        self.requests = {"atlas": 0, "ripestat": 0}
+        self._lock = threading.Lock()
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"   # keep-alive, like the real APIs
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                stand_in._handle(self)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.base = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def _count(self, key: str):
+        with self._lock:
+            self.requests[key] += 1
+
+    def _handle(self, req: BaseHTTPRequestHandler):
+        if self.latency:
+            time.sleep(self.latency)
+        url = urlsplit(req.path)
+        q = parse_qs(url.query)
+        if url.path.startswith("/api/v2/measurements/"):
+            self._count("atlas")
+            msm_id = int(url.path.split("/")[4])
+            probe_ids = [int(p) for p in q["probe_ids"][0].split(",")]
+            body = synth_results(msm_id, probe_ids, int(q["start"][0]), int(q["stop"][0]),
+                                 self.interval, **self.synth_kwargs)
+        elif url.path == "/data/network-info/data.json":
+            self._count("ripestat")
+            ip = q["resource"][0]
+            body = {"data": {"asns": synth_asn(ip), "prefix": ip}}
+        else:
+            req.send_error(404)
+            return
+        payload = json.dumps(body).encode()
+        req.send_response(200)
+        req.send_header("Content-Type", "application/json")
+        req.send_header("Content-Length", str(len(payload)))
+        req.end_headers()
+        req.wfile.write(payload)
+
+    def __enter__(self):
+        self._thread.start()
+        self._saved = (z.ATLAS_RESULTS_URL, z.RIPESTAT_NETWORK_INFO_URL, z.DEFAULT_RATE_LIMIT)
+        z.ATLAS_RESULTS_URL = self.base + "/api/v2/measurements/{measurement_id}/results/"
+        z.RIPESTAT_NETWORK_INFO_URL = self.base + "/data/network-info/data.json?resource={ip}"
+        z.DEFAULT_RATE_LIMIT = 1000.0   # the stand-in is not rate limited
+        return self
+
+    def __exit__(self, *exc):
+        z.ATLAS_RESULTS_URL, z.RIPESTAT_NETWORK_INFO_URL, z.DEFAULT_RATE_LIMIT = self._saved
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# -------------------
+# Measurement
+# -------------------
+def measure(name: str, fn: Callable[[], int], unit: str,
+            setup: Optional[Callable[[], None]] = None) -> Dict[str, Any]:
+    """
+    Run fn() (returns items processed) twice: once under tracemalloc for the
+    peak heap, then untraced for the time, since tracing slows Python code
+    down several times over. `setup` runs before each of the two runs.
+    """
+    if setup:
+        setup()
+    gc.collect()
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    if setup:
+        setup()
+    gc.collect()
+    t0 = time.perf_counter()
+    n = fn()
+    elapsed = time.perf_counter() - t0
+    result = {
+        "benchmark": name, "items": n, "unit": unit, "seconds": round(elapsed, 4),
+        "per_second": round(n / elapsed, 1) if elapsed else None,
+        "peak_mb": round(peak / 1024 ** 2, 2),
+    }
+    print(f"{name:<28} {n:>9} {unit:<12} {elapsed:>8.3f}s "
+          f"{result['per_second'] or 0:>12,.0f}/s {result['peak_mb']:>9.2f} MB")
+    return result
+
+
+def reset_z_state(workdir: str):
+    """Fresh, empty caches so runs do not warm each other up."""
+    z.asn_cache.clear()
+    z.negative_asn_cache.clear()
+    z.ASN_CACHE_DB = os.path.join(workdir, f"asn_{time.monotonic_ns()}.sqlite3")
+    z.ASN_CACHE_FILE = os.path.join(workdir, "no_legacy_cache.json")
+    z._asn_store = None
+    z._transport = None
+    z.window_cache = None
+    z.OFFLINE = False
+
+
+# -------------------
+# Benchmarks
+# -------------------
+def bench_parse(opts, workdir) -> List[Dict[str, Any]]:
+    path = write_results_file(os.path.join(workdir, "results.json"), opts.traceroutes,
+                              **_synth_kwargs(opts))
+    out = []
+    for backend in z.PARSER_BACKENDS:
+        if backend == "orjson":
+            try:
+                import orjson  # noqa: F401
+            except ImportError:
+                continue
+
+        def run(backend=backend):
+            with open(path, "rb") as f:
+                return sum(1 for _ in z.iter_traceroute_hops(f, backend))
+        out.append(measure(f"parse[{backend}]", run, "traceroutes"))
+    return out
+
+
+def _consume(it) -> int:
+    """Exhaust an iterable (lookups are run for their cost) and return its length."""
+    return sum(1 for _ in it)
+
+
+def bench_asn(opts, workdir) -> List[Dict[str, Any]]:
+    rnd = random.Random(7)
+    ips = [f"{rnd.randint(1, 223)}.{rnd.randint(0, 255)}.{rnd.randint(0, 255)}.{rnd.randint(1, 254)}"
+           for _ in range(opts.unique_ips)]
+    lookups = [rnd.choice(ips) for _ in range(opts.unique_ips * 10)]   # heavy repetition
+    out = []
+    with AtlasStandIn(latency=opts.latency_ms / 1000):
+        cold = lambda: reset_z_state(workdir)   # noqa: E731
+        out.append(measure("asn[serial get_single_asn]",
+                           lambda: _consume(z.get_single_asn(ip) for ip in lookups), "lookups",
+                           setup=cold))
+        out.append(measure("asn[bulk resolve_asns]",
+                           lambda: z.resolve_asns(lookups) and len(lookups), "lookups",
+                           setup=cold))
+        out.append(measure("asn[warm cache]",
+                           lambda: z.resolve_asns(lookups) and len(lookups), "lookups"))
+    return out
+
+
+def bench_ixp(opts, workdir) -> List[Dict[str, Any]]:
+    rnd = random.Random(11)
+    nets = [ipaddress.ip_network(f"{rnd.randint(1, 223)}.{rnd.randint(0, 255)}."
+                                 f"{rnd.randint(0, 255)}.0/{rnd.choice([22, 23, 24])}", strict=False)
+            for _ in range(opts.ixp_prefixes)]
+    ips = [f"{rnd.randint(1, 223)}.{rnd.randint(0, 255)}.{rnd.randint(0, 255)}.{rnd.randint(1, 254)}"
+           for _ in range(opts.ixp_lookups)]
+    index = z.IxpIndex(nets)
+    out = [measure("ixp[IxpIndex]", lambda: _consume(z.is_ip_in_ixp(ip, index) for ip in ips),
+                   "lookups")]
+    few = ips[: max(1, len(ips) // 100)]
+    out.append(measure("ixp[linear scan, 1%]",
+                       lambda: _consume(z.is_ip_in_ixp(ip, nets) for ip in few), "lookups"))
+    return out
+
+
+def _synth_kwargs(opts) -> Dict[str, Any]:
+    """Shape of the synthetic traceroutes, from --hops / --timeout-rate."""
+    return {"hops": opts.hops, "timeout_rate": opts.timeout_rate}
+
+
+def _analysis_args(opts):
+    probe_ids = list(range(1, opts.probes + 1))
+    start = z.START_TIMESTAMP
+    stop = start + opts.days * 86400
+    return probe_ids, start, stop
+
+
+def bench_analyze(opts, workdir) -> List[Dict[str, Any]]:
+    probe_ids, start, stop = _analysis_args(opts)
+    measurements = z.ROOTSERVERS[: opts.measurements]
+    root_map = {"k-root": {ROOT_ASN}}
+    out = []
+    with AtlasStandIn(latency=opts.latency_ms / 1000, **_synth_kwargs(opts)) as stand_in:
+        def cold():
+            reset_z_state(workdir)
+            stand_in.requests = dict.fromkeys(stand_in.requests, 0)
+
+        for workers in sorted({1, opts.workers}):
+            def run(workers=workers):
+                return sum(1 for _ in z.iter_root_measurements(
+                    measurements, probe_ids, start, stop, {}, root_map, z.IxpIndex([]),
+                    workers=workers))
+            result = measure(f"analyze[workers={workers}]", run, "records", setup=cold)
+            result["requests"] = dict(stand_in.requests)
+            out.append(result)
+    return out
+
+
+def _export_records(opts) -> List[Dict[str, Any]]:
+    rnd = random.Random(3)
+    records = []
+    for i in range(opts.export_rows):
+        hops = tuple(f"10.{rnd.randint(0, 255)}.{rnd.randint(0, 255)}.{h}" for h in range(rnd.randint(4, 12)))
+        records.append({
+            "probe_id": i % 20, "root": "k-root", "dest_ip": hops[-1], "dest_asn": ROOT_ASN,
+            "penult_ip": hops[-2], "penult_asn": 64512 + i % 500,
+            "relationship_penult_to_root": rnd.choice(["-1", "0", "No Relationship"]),
+            "penult_in_ixp": bool(i % 7 == 0), "full_traceroute": hops,
+        })
+    return records
+
+
+def bench_export(opts, workdir) -> List[Dict[str, Any]]:
+    records = _export_records(opts)
+    out = [
+        measure("export[csv]", lambda: z.write_records(
+            records, [z.CsvSink(os.path.join(workdir, "bench.csv"))]), "rows"),
+        measure("export[xlsx]", lambda: z.write_records(
+            records, [z.XlsxSink(os.path.join(workdir, "bench.xlsx"), workers=1)]), "rows"),
+    ]
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return out
+    out.append(measure("export[parquet]", lambda: z.write_records(
+        records, [z.ColumnarSink(os.path.join(workdir, "bench.parquet"))]), "rows"))
+    return out
+
+
+BENCHMARKS = {
+    "parse": bench_parse,
+    "asn": bench_asn,
+    "ixp": bench_ixp,
+    "analyze": bench_analyze,
+    "export": bench_export,
+}
+
+
+def _hop_range(value: str) -> Tuple[int, int]:
+    """"N" or "MIN-MAX" hops per traceroute."""
+    try:
+        low, _, high = value.partition("-")
+        hops = (int(low), int(high or low))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected N or MIN-MAX, got {value!r}")
+    if not 2 <= hops[0] <= hops[1]:
+        raise argparse.ArgumentTypeError(f"need 2 <= MIN <= MAX, got {value!r}")
+    return hops
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for z.py on synthetic Atlas data.")
+    parser.add_argument("--only", default=",".join(BENCHMARKS),
+                        help=f"comma-separated subset of: {', '.join(BENCHMARKS)}")
+    parser.add_argument("--latency-ms", type=float, default=20.0,
+                        help="latency the API stand-in adds to every request")
+    parser.add_argument("--hops", type=_hop_range, default=(6, 16),
+                        help="parse/analyze: hops per synthetic traceroute, N or MIN-MAX (default 6-16)")
+    parser.add_argument("--timeout-rate", type=float, default=0.15,
+                        help="parse/analyze: share of hops that time out (default 0.15)")
+    parser.add_argument("--traceroutes", type=int, default=5000, help="parse: traceroutes in the file")
+    parser.add_argument("--unique-ips", type=int, default=300, help="asn: distinct IPs looked up")
+    parser.add_argument("--ixp-prefixes", type=int, default=3000, help="ixp: prefixes in the list")
+    parser.add_argument("--ixp-lookups", type=int, default=100_000, help="ixp: addresses tested")
+    parser.add_argument("--probes", type=int, default=5, help="analyze: probes")
+    parser.add_argument("--measurements", type=int, default=2, help="analyze: root measurements")
+    parser.add_argument("--days", type=int, default=90, help="analyze: days of results")
+    parser.add_argument("--workers", type=int, default=z.FETCH_WORKERS, help="analyze: fetch workers")
+    parser.add_argument("--export-rows", type=int, default=20_000, help="export: rows written")
+    parser.add_argument("--json", help="also write the results to this JSON file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> List[Dict[str, Any]]:
+    opts = parse_args(argv)
+    selected = [name.strip() for name in opts.only.split(",") if name.strip()]
+    unknown = [name for name in selected if name not in BENCHMARKS]
+    if unknown:
+        print(f"[ERROR] Unknown benchmarks: {', '.join(unknown)}")
+        sys.exit(1)
+
+    workdir = tempfile.mkdtemp(prefix="bench_z_")
+    results: List[Dict[str, Any]] = []
+    print(f"{'benchmark':<28} {'items':>9} {'unit':<12} {'time':>9} {'throughput':>14} {'peak heap':>12}")
+    try:
+        for name in selected:
+            results.extend(BENCHMARKS[name](opts, workdir))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if opts.json:
+        with open(opts.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()